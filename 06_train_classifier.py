@@ -112,6 +112,14 @@ def parse_arguments():
                         choices=['rbf', 'sigmoid', 'linear', 'poly'],
                         help='(SVM) kernel type')
 
+    parser.add_argument('-stes',
+                        '--svm-train-eval-size',
+                        dest='train_eval_size',
+                        action='store',
+                        type=int,
+                        default=None,
+                        help='(SVM) number of training examples sampled to compute training metrics. If not given, the entire training set is used')
+
     parser.add_argument('-rfne',
                         '--rf-num-estimators',
                         dest='n_estimators',
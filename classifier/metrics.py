@@ -32,10 +32,14 @@ def compute_metrics(y, pred, num_classes=10):
 
     acc = (y == pred).mean()
 
-    class_acc = []
-    for class_idx in range(num_classes):
-        idxs = (y == class_idx)
-        class_acc.append((y[idxs] == pred[idxs]).mean())
+    # Tally the confusion matrix in a single pass over the labels, where
+    # rows correspond to true classes and columns to predicted classes
+    confusion = np.bincount(num_classes * y.astype(int) + pred.astype(int),
+                            minlength=num_classes ** 2)
+    confusion = confusion.reshape(num_classes, num_classes)
+    # Classes with no examples get NaN accuracy, as with an empty mean
+    with np.errstate(divide='ignore', invalid='ignore'):
+        class_acc = list(np.diag(confusion) / confusion.sum(axis=1))
 
     ave_class_acc = np.mean(class_acc)
 
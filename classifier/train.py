@@ -2,12 +2,12 @@ import datetime
 import getpass
 import json
 import os
-import pickle as pk
 import random
 import git
 from itertools import product
 import time
 
+import joblib
 import keras
 import keras.regularizers as regularizers
 from tensorflow import set_random_seed
@@ -16,7 +16,6 @@ from keras.layers import Input, Dense
 from keras.models import Model
 from keras.optimizers import Adam
 from sklearn.metrics import hinge_loss
-from sklearn.externals import joblib
 from sklearn.preprocessing import OneHotEncoder
 from sklearn.model_selection import StratifiedShuffleSplit
 from sklearn.svm import SVC
@@ -25,7 +24,6 @@ from sklearn.ensemble import RandomForestClassifier
 from classifier.metrics import compute_metrics
 from data.usc.features import preprocess_split_data
 from data.usc.folds import get_split
-from l3embedding.train import LossHistory
 from log import *
 
 from gsheets import get_credentials, append_row, update_experiment, CLASSIFIER_FIELD_NAMES
@@ -41,6 +39,10 @@ DATASET_NUM_CLASSES = {
     'dcase2013': 10,
 }
 
+# Number of examples per batch when running inference with Keras models,
+# which otherwise defaults to batches of 32
+PREDICT_BATCH_SIZE = 1024
+
 
 class MetricCallback(keras.callbacks.Callback):
 
@@ -52,33 +54,67 @@ class MetricCallback(keras.callbacks.Callback):
     def on_train_begin(self, logs=None):
         if logs is None:
             logs = {}
-        self.train_loss = []
-        self.valid_loss = []
-        self.train_acc = []
-        self.valid_acc = []
+        # Preallocate the histories for the maximum number of epochs
+        num_epochs = self.params['epochs']
+        self.num_epochs_run = 0
+        self.train_loss = np.full(num_epochs, np.nan, dtype=np.float32)
+        self.valid_loss = np.full(num_epochs, np.nan, dtype=np.float32)
+        self.train_acc = np.full(num_epochs, np.nan, dtype=np.float32)
+        self.valid_acc = np.full(num_epochs, np.nan, dtype=np.float32)
 
     # def on_batch_end(self, batch, logs={}):
     def on_epoch_end(self, epoch, logs=None):
         if logs is None:
             logs = {}
-        self.train_loss.append(logs.get('loss'))
-        self.valid_loss.append(logs.get('val_loss'))
-        self.train_acc.append(logs.get('acc'))
-        self.valid_acc.append(logs.get('val_acc'))
+        self.train_loss[epoch] = logs.get('loss', np.nan)
+        self.valid_loss[epoch] = logs.get('val_loss', np.nan)
+        self.train_acc[epoch] = logs.get('acc', np.nan)
+        self.valid_acc[epoch] = logs.get('val_acc', np.nan)
+        self.num_epochs_run = epoch + 1
 
         if self.verbose:
             train_msg = 'Train - loss: {}, acc: {}'
             valid_msg = 'Valid - loss: {}, acc: {}'
             LOGGER.info('Epoch {}'.format(epoch))
-            LOGGER.info(train_msg.format(self.train_loss[-1],
-                                         self.train_acc[-1]))
-            LOGGER.info(valid_msg.format(self.valid_loss[-1],
-                                         self.valid_acc[-1]))
+            LOGGER.info(train_msg.format(self.train_loss[epoch],
+                                         self.train_acc[epoch]))
+            LOGGER.info(valid_msg.format(self.valid_loss[epoch],
+                                         self.valid_acc[epoch]))
+
+    def on_train_end(self, logs=None):
+        # Trim the epochs that were not run, e.g. due to early stopping
+        self.train_loss = self.train_loss[:self.num_epochs_run]
+        self.valid_loss = self.valid_loss[:self.num_epochs_run]
+        self.train_acc = self.train_acc[:self.num_epochs_run]
+        self.valid_acc = self.valid_acc[:self.num_epochs_run]
+
+
+def predict_file_classes(y_frame_pred, file_idxs):
+    """
+    Aggregate frame-level class probabilities into file-level predictions
+    by averaging the probabilities over the frames of each file
+
+    Args:
+        y_frame_pred: Frame-level class probabilities
+                      (Type: np.ndarray)
+        file_idxs: Start and end frame indices for each file, where files
+                   are stored contiguously and in order
+                   (Type: np.ndarray)
+
+    Returns:
+        y_pred: Predicted class for each file
+                (Type: np.ndarray)
+    """
+    file_idxs = np.asarray(file_idxs)
+    # Sum the frame probabilities of each file in a single pass. Since each
+    # file's sum is a positive multiple of its mean, the argmax is unchanged
+    file_sums = np.add.reduceat(y_frame_pred, file_idxs[:, 0], axis=0)
+    return np.argmax(file_sums, axis=1)
 
 
 def train_svm(train_data, valid_data, test_data, model_dir, C=1.0, kernel='rbf',
               num_classes=10, tol=0.001, max_iterations=-1, verbose=False,
-              random_state=12345678, **kwargs):
+              random_state=12345678, train_eval_size=None, **kwargs):
     """
     Train a Support Vector Machine model on the given data
 
@@ -99,6 +135,11 @@ def train_svm(train_data, valid_data, test_data, model_dir, C=1.0, kernel='rbf',
         verbose:  If True, print verbose messages
                   (Type: bool)
 
+        train_eval_size: If given, number of randomly sampled training
+                         examples used to compute the training metrics,
+                         rather than the entire training set
+                         (Type: int)
+
     Returns:
         clf: Classifier object
              (Type: sklearn.svm.SVC)
@@ -115,8 +156,6 @@ def train_svm(train_data, valid_data, test_data, model_dir, C=1.0, kernel='rbf',
     X_train = train_data['features']
     y_train = train_data['labels']
 
-    model_output_path = os.path.join(model_dir, "model.pkl")
-
     # Create classifier
     clf = SVC(C=C, probability=True, kernel=kernel, max_iter=max_iterations,
               tol=tol, random_state=random_state, verbose=verbose)
@@ -125,14 +164,23 @@ def train_svm(train_data, valid_data, test_data, model_dir, C=1.0, kernel='rbf',
     LOGGER.debug('Fitting model to data...')
     clf.fit(X_train, y_train)
 
-    LOGGER.info('Saving model...')
-    joblib.dump(clf, model_output_path)
+    # Evaluating the kernel over the entire training set can cost as much as
+    # fitting, so optionally estimate the training metrics on a subset
+    if train_eval_size and train_eval_size < len(y_train):
+        rng = np.random.RandomState(random_state)
+        eval_idxs = rng.choice(len(y_train), train_eval_size, replace=False)
+        X_train_eval, y_train_eval = X_train[eval_idxs], y_train[eval_idxs]
+    else:
+        X_train_eval, y_train_eval = X_train, y_train
 
-    y_train_pred = clf.predict(X_train)
+    # Evaluate the decision function once and derive the predictions from it,
+    # rather than running the kernel over the training set a second time
+    train_decision = clf.decision_function(X_train_eval)
+    y_train_pred = clf.classes_[np.argmax(train_decision, axis=1)]
     # Compute new metrics
     classes = np.arange(num_classes)
-    train_loss = hinge_loss(y_train, clf.decision_function(X_train), labels=classes)
-    train_metrics = compute_metrics(y_train, y_train_pred, num_classes=num_classes)
+    train_loss = hinge_loss(y_train_eval, train_decision, labels=classes)
+    train_metrics = compute_metrics(y_train_eval, y_train_pred, num_classes=num_classes)
     train_metrics['loss'] = train_loss
     train_msg = 'Train - hinge loss: {}, acc: {}'
     LOGGER.info(train_msg.format(train_loss, train_metrics['accuracy']))
@@ -140,8 +188,9 @@ def train_svm(train_data, valid_data, test_data, model_dir, C=1.0, kernel='rbf',
     if valid_data:
         X_valid = valid_data['features']
         y_valid = valid_data['labels']
-        y_valid_pred = clf.predict(X_valid)
-        valid_loss = hinge_loss(y_valid, clf.decision_function(X_valid), labels=classes)
+        valid_decision = clf.decision_function(X_valid)
+        y_valid_pred = clf.classes_[np.argmax(valid_decision, axis=1)]
+        valid_loss = hinge_loss(y_valid, valid_decision, labels=classes)
         valid_metrics = compute_metrics(y_valid, y_valid_pred, num_classes=num_classes)
         valid_metrics['loss'] = valid_loss
         valid_msg = 'Valid - hinge loss: {}, acc: {}'
@@ -153,12 +202,7 @@ def train_svm(train_data, valid_data, test_data, model_dir, C=1.0, kernel='rbf',
     if test_data:
         X_test = test_data['features']
         y_test_pred_frame = clf.predict_proba(X_test)
-        y_test_pred = []
-        for start_idx, end_idx in test_data['file_idxs']:
-            class_pred = y_test_pred_frame[start_idx:end_idx].mean(axis=0).argmax()
-            y_test_pred.append(class_pred)
-
-        y_test_pred = np.array(y_test_pred)
+        y_test_pred = predict_file_classes(y_test_pred_frame, test_data['file_idxs'])
         test_metrics = compute_metrics(test_data['labels'], y_test_pred, num_classes=num_classes)
     else:
         test_metrics = {}
@@ -174,11 +218,11 @@ def train_rf(train_data, valid_data, test_data, model_dir, n_estimators=100,
     np.random.seed(random_state)
     random.seed(random_state)
 
-    X_train = train_data['features']
+    # Trees are fit and evaluated in single precision, so convert once here
+    # instead of on every call to fit and predict
+    X_train = np.ascontiguousarray(train_data['features'], dtype=np.float32)
     y_train = train_data['labels']
 
-    model_output_path = os.path.join(model_dir, "model.pkl")
-
     # Create classifier
     clf = RandomForestClassifier(n_estimators=n_estimators, n_jobs=-1,
                                  random_state=random_state)
@@ -187,9 +231,6 @@ def train_rf(train_data, valid_data, test_data, model_dir, n_estimators=100,
     LOGGER.debug('Fitting model to data...')
     clf.fit(X_train, y_train)
 
-    LOGGER.info('Saving model...')
-    joblib.dump(clf, model_output_path)
-
     y_train_pred = clf.predict(X_train)
     # Compute new metrics
     train_loss = 0
@@ -199,7 +240,7 @@ def train_rf(train_data, valid_data, test_data, model_dir, n_estimators=100,
     LOGGER.info(train_msg.format(train_loss, train_metrics['accuracy']))
 
     if valid_data:
-        X_valid = valid_data['features']
+        X_valid = np.ascontiguousarray(valid_data['features'], dtype=np.float32)
         y_valid = valid_data['labels']
         y_valid_pred = clf.predict(X_valid)
         valid_loss = 0
@@ -212,14 +253,9 @@ def train_rf(train_data, valid_data, test_data, model_dir, n_estimators=100,
 
     # Evaluate model on test data
     if test_data:
-        X_test = test_data['features']
+        X_test = np.ascontiguousarray(test_data['features'], dtype=np.float32)
         y_test_pred_frame = clf.predict_proba(X_test)
-        y_test_pred = []
-        for start_idx, end_idx in test_data['file_idxs']:
-            class_pred = y_test_pred_frame[start_idx:end_idx].mean(axis=0).argmax()
-            y_test_pred.append(class_pred)
-
-        y_test_pred = np.array(y_test_pred)
+        y_test_pred = predict_file_classes(y_test_pred_frame, test_data['file_idxs'])
         test_metrics = compute_metrics(test_data['labels'], y_test_pred, num_classes=num_classes)
     else:
         test_metrics = {}
@@ -257,6 +293,32 @@ def construct_mlp_model(input_shape, weight_decay=1e-5, num_classes=10):
     return m, inp, y
 
 
+def fuse_standardizer(m, stdizer):
+    """
+    Fold feature standardization into the first dense layer of a model
+    constructed by construct_mlp_model, so that the model can be applied
+    directly to unstandardized features. The model is modified in place.
+
+    Args:
+        m: MLP model trained on standardized features
+           (Type: keras.models.Model)
+        stdizer: Standardizer fit on the training features
+                 (Type: sklearn.preprocessing.StandardScaler)
+
+    Returns:
+        m: MLP model with standardization folded into its first layer
+           (Type: keras.models.Model)
+    """
+    # Dense((x - mean) / scale) = x (W / scale) + (b - (mean / scale) W)
+    dense = m.layers[1]
+    W, b = dense.get_weights()
+    W_fused = W / stdizer.scale_[:, np.newaxis]
+    b_fused = b - np.dot(stdizer.mean_ / stdizer.scale_, W)
+    dense.set_weights([W_fused.astype(W.dtype), b_fused.astype(b.dtype)])
+
+    return m
+
+
 def train_mlp(train_data, valid_data, test_data, model_dir,
               batch_size=64, num_epochs=100, valid_split=0.15, patience=20,
               learning_rate=1e-4, weight_decay=1e-5, num_classes=10,
@@ -298,15 +360,17 @@ def train_mlp(train_data, valid_data, test_data, model_dir,
     monitor = 'val_loss'
     #set_random_seed(random_state)
 
-    # Set up data inputs
+    # Set up data inputs. The set of classes is known up front, so the
+    # encoder is fit once and reused for the validation labels
     enc = OneHotEncoder(n_values=num_classes, sparse=False)
 
-    X_train = train_data['features']
+    # Convert to the Keras float type once, rather than for every batch
+    X_train = np.ascontiguousarray(train_data['features'], dtype=np.float32)
     y_train = enc.fit_transform(train_data['labels'].reshape(-1, 1))
 
     if valid_data:
-        validation_data = (valid_data['features'],
-                           enc.fit_transform(valid_data['labels'].reshape(-1, 1)))
+        validation_data = (np.ascontiguousarray(valid_data['features'], dtype=np.float32),
+                           enc.transform(valid_data['labels'].reshape(-1, 1)))
         valid_split = 0.0
     else:
         validation_data = None
@@ -324,8 +388,6 @@ def train_mlp(train_data, valid_data, test_data, model_dir,
                                               save_best_only=True,
                                               monitor=monitor))
     cb.append(keras.callbacks.EarlyStopping(monitor='val_loss', patience=patience))
-    history_checkpoint = os.path.join(model_dir, 'history_checkpoint.pkl')
-    cb.append(LossHistory(history_checkpoint))
     history_csvlog = os.path.join(model_dir, 'history_csvlog.csv')
     cb.append(keras.callbacks.CSVLogger(history_csvlog, append=True,
                                         separator=','))
@@ -348,42 +410,34 @@ def train_mlp(train_data, valid_data, test_data, model_dir,
     checkpoint_idx = np.argmin(metric_cb.valid_loss)
 
     # Compute metrics for train and valid
-    train_pred = m.predict(X_train)
+    train_pred = m.predict(X_train, batch_size=PREDICT_BATCH_SIZE)
     train_metrics = compute_metrics(y_train, train_pred, num_classes=num_classes)
     # Set up train and validation metrics
     train_metrics = {
         'loss': metric_cb.train_loss[checkpoint_idx],
-        'loss_history': list(metric_cb.train_loss),
+        'loss_history': metric_cb.train_loss,
         'accuracy': metric_cb.train_acc[checkpoint_idx],
-        'accuracy_history': list(metric_cb.train_acc),
+        'accuracy_history': metric_cb.train_acc,
         'class_accuracy': train_metrics['class_accuracy'],
         'average_class_accuracy': train_metrics['average_class_accuracy']
     }
 
     valid_metrics = {
         'loss': metric_cb.valid_loss[checkpoint_idx],
-        'loss_history': list(metric_cb.valid_loss),
+        'loss_history': metric_cb.valid_loss,
         'accuracy': metric_cb.valid_acc[checkpoint_idx],
-        'accuracy_history': list(metric_cb.valid_acc),
+        'accuracy_history': metric_cb.valid_acc,
     }
 
     if valid_data:
-        valid_pred = m.predict(validation_data[0])
+        valid_pred = m.predict(validation_data[0], batch_size=PREDICT_BATCH_SIZE)
         valid_metrics.update(compute_metrics(validation_data[1], valid_pred, num_classes=num_classes))
-        valid_metrics.update({
-            'class_accuracy': valid_metrics['class_accuracy'],
-            'average_class_accuracy': valid_metrics['average_class_accuracy']
-        })
 
     if test_data:
         # Evaluate model on test data
-        X_test = test_data['features']
-        y_test_pred_frame = m.predict(X_test)
-        y_test_pred = []
-        for start_idx, end_idx in test_data['file_idxs']:
-            class_pred = y_test_pred_frame[start_idx:end_idx].mean(axis=0).argmax()
-            y_test_pred.append(class_pred)
-        y_test_pred = np.array(y_test_pred)
+        X_test = np.ascontiguousarray(test_data['features'], dtype=np.float32)
+        y_test_pred_frame = m.predict(X_test, batch_size=PREDICT_BATCH_SIZE)
+        y_test_pred = predict_file_classes(y_test_pred_frame, test_data['file_idxs'])
         test_metrics = compute_metrics(test_data['labels'], y_test_pred, num_classes=num_classes)
     else:
         test_metrics = {}
@@ -598,9 +652,9 @@ def train(features_dir, output_dir, fold_num,
                                                 use_min_max=use_min_max)
 
     min_max_scaler_output_path = os.path.join(model_dir, "min_max_scaler.pkl")
-    joblib.dump(min_max_scaler, min_max_scaler_output_path)
+    joblib.dump(min_max_scaler, min_max_scaler_output_path, compress=3)
     stdizer_output_path = os.path.join(model_dir, "stdizer.pkl")
-    joblib.dump(stdizer, stdizer_output_path)
+    joblib.dump(stdizer, stdizer_output_path, compress=3)
 
     LOGGER.info('Training {} with fold {} held out'.format(model_type, fold_num))
     # Fit the model
@@ -659,6 +713,20 @@ def train(features_dir, output_dir, fold_num,
     else:
         raise ValueError('Invalid model type: {}'.format(model_type))
 
+    if model_type in ('svm', 'rf'):
+        # Save the final model once, rather than after every fit during
+        # parameter search (MLP weights are checkpointed during training)
+        LOGGER.info('Saving model...')
+        model_output_path = os.path.join(model_dir, "model.pkl")
+        joblib.dump(model, model_output_path, compress=3)
+    elif model_type == 'mlp':
+        # Also save a copy of the model that applies standardization itself,
+        # so that inference can skip the separate stdizer.transform pass
+        LOGGER.info('Saving model with fused standardization...')
+        fused_model_output_path = os.path.join(model_dir, "model_fused.h5")
+        fuse_standardizer(model, stdizer).save(fused_model_output_path,
+                                               include_optimizer=False)
+
     # Assemble metrics for this training run
     results = {
         'train': train_metrics,
@@ -670,8 +738,7 @@ def train(features_dir, output_dir, fold_num,
 
     # Save results to disk
     results_file = os.path.join(model_dir, 'results.pkl')
-    with open(results_file, 'wb') as fp:
-        pk.dump(results, fp, protocol=pk.HIGHEST_PROTOCOL)
+    joblib.dump(results, results_file, compress=3)
 
 
     if gsheet_id:
@@ -87,12 +87,10 @@ def framewise_to_stats(data):
 
 
 def expand_framewise_labels(data):
-    labels = []
-    for y, (start_idx, end_idx) in zip(data['labels'], data['file_idxs']):
-        num_frames = end_idx - start_idx
-        labels.append(np.tile(y, num_frames))
-
-    data['labels'] = np.concatenate(labels)
+    # Repeat each file label for all of its frames in a single call
+    file_idxs = np.asarray(data['file_idxs'])
+    num_frames = file_idxs[:, 1] - file_idxs[:, 0]
+    data['labels'] = np.repeat(data['labels'], num_frames)
 
 
 def preprocess_split_data(train_data, valid_data, test_data,
@@ -130,12 +128,14 @@ def preprocess_split_data(train_data, valid_data, test_data,
     else:
         raise ValueError('Invalid feature mode: {}'.format(feature_mode))
 
-    # Standardize features
+    # Standardize features in place, since the unscaled features are not
+    # needed afterwards
     stdizer = StandardScaler()
-    train_data['features'] = stdizer.fit_transform(train_data['features'])
+    stdizer.fit(train_data['features'])
+    train_data['features'] = stdizer.transform(train_data['features'], copy=False)
     if valid_data:
-        valid_data['features'] = stdizer.transform(valid_data['features'])
-    test_data['features'] = stdizer.transform(test_data['features'])
+        valid_data['features'] = stdizer.transform(valid_data['features'], copy=False)
+    test_data['features'] = stdizer.transform(test_data['features'], copy=False)
 
     # Shuffle training data
     num_train_examples = len(train_data['labels'])
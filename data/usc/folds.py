@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 from .us8k import NUM_FOLDS as NUM_FOLDS_US8K
@@ -21,7 +22,7 @@ def load_feature_file(feature_filepath):
     return X, y
 
 
-def get_fold(feature_dir, fold_idx, augment=False):
+def get_fold(feature_dir, fold_idx, augment=False, num_workers=8):
     X = []
     y = []
     file_idxs = []
@@ -29,15 +30,22 @@ def get_fold(feature_dir, fold_idx, augment=False):
 
     filenames = os.listdir(fold_dir)
 
-    start_idx = 0
+    feature_filepaths = []
     for feature_filename in filenames:
         # Hack for skipping augmented files for US8K
         if 'us8k' in fold_dir and '_' in feature_filename and not augment:
             continue
 
-        feature_filepath = os.path.join(fold_dir, feature_filename)
-        file_X, file_y = load_feature_file(feature_filepath)
+        feature_filepaths.append(os.path.join(fold_dir, feature_filename))
+
+    # Load the feature files from a pool of threads so that reading and
+    # decompressing one file overlaps with the others. map() preserves the
+    # order of the files
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        fold_file_data = list(executor.map(load_feature_file, feature_filepaths))
 
+    start_idx = 0
+    for file_X, file_y in fold_file_data:
         if file_X.ndim > 1:
             end_idx = start_idx + file_X.shape[0]
         else:
@@ -11,7 +11,6 @@ import numpy as np
 import keras
 from keras.optimizers import Adam
 import pescador
-from skimage import img_as_float
 
 from gsheets import get_credentials, append_row, update_experiment, get_row
 from .model import MODELS, load_model
@@ -50,7 +49,7 @@ class LossHistory(keras.callbacks.Callback):
 
         loss_dict = {'loss': self.loss, 'val_loss': self.val_loss}
         with open(self.outfile, 'wb') as fp:
-            pickle.dump(loss_dict, fp)
+            pickle.dump(loss_dict, fp, protocol=pickle.HIGHEST_PROTOCOL)
 
 class GSheetLogger(keras.callbacks.Callback):
     """
@@ -182,8 +181,13 @@ def data_generator(data_dir, batch_size=512, random_state=20180123,
                 # If we are starting from a particular batch, skip yielding all
                 # of the prior batches
                 if start_batch_idx is None or batch_idx >= start_batch_idx:
-                    # Preprocess video so samples are in [-1,1]
-                    batch['video'] = 2 * img_as_float(batch['video']).astype('float32') - 1
+                    # Preprocess video so samples are in [-1,1]. Frames are
+                    # stored as uint8, so rescale them directly in single
+                    # precision rather than going through a float64 copy
+                    video = batch['video'].astype('float32')
+                    video *= 2. / 255.
+                    video -= 1
+                    batch['video'] = video
 
                     # Convert audio to float
                     batch['audio'] = pcm2float(batch['audio'], dtype='float32')
@@ -307,7 +311,7 @@ def train(train_data_dir, validation_data_dir, output_dir,
     model_spec_path = os.path.join(model_dir, 'model_spec.pkl')
     model_spec = keras.utils.serialize_keras_object(m)
     with open(model_spec_path, 'wb') as fd:
-        pickle.dump(model_spec, fd)
+        pickle.dump(model_spec, fd, protocol=pickle.HIGHEST_PROTOCOL)
     model_json_path = os.path.join(model_dir, 'model.json')
     model_json = m.to_json()
     with open(model_json_path, 'w') as fd:
@@ -416,6 +420,6 @@ def train(train_data_dir, validation_data_dir, output_dir,
     LOGGER.info('Done training. Saving results to disk...')
     # Save history
     with open(os.path.join(model_dir, 'history.pkl'), 'wb') as fd:
-        pickle.dump(history.history, fd)
+        pickle.dump(history.history, fd, protocol=pickle.HIGHEST_PROTOCOL)
 
     LOGGER.info('Done!')